@@ -1,6 +1,10 @@
 import os
 import sys
-from flask import Flask, render_template, request, jsonify
+import json
+import time
+import threading
+import hmac
+from flask import Flask, render_template, request, jsonify, g, send_from_directory
 from prometheus_flask_exporter import PrometheusMetrics
 
 # Aggiungi la cartella 'src' al path di Python per permettere le importazioni
@@ -10,13 +14,79 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 try:
     from src.dataprocessing import DocumentProcessor
     from src.retrieval import Retriever
-    from src.generation import Generator
+    from src.generation import Generator, StubBackend, ExtractiveBackend, CircuitBreaker
+    from src import tracing, profiling
 except ImportError:
     print("Errore: Impossibile importare i moduli da /src.")
     print("Assicurati che 'src' sia nella root del progetto e contenga __init__.py (anche se vuoto)")
     sys.exit(1)
 
 
+# --- Configurazione (da variabili d'ambiente) ---
+
+# Se impostato, ogni richiesta a /ask viene registrata (una riga JSON) in questo file.
+# Il file può poi essere rigiocato con 'src/replay.py'.
+CAPTURE_PATH = os.getenv("RAG_CAPTURE_PATH", "")
+# Se "1", usa un LLM finto (StubBackend) al posto di Gemini: utile per i test di carico.
+USE_STUB_LLM = os.getenv("RAG_STUB_LLM", "0") == "1"
+STUB_LLM_LATENCY_S = float(os.getenv("RAG_STUB_LLM_LATENCY", "0.5"))
+STUB_LLM_FAILURE_RATE = float(os.getenv("RAG_STUB_LLM_FAILURE_RATE", "0"))
+# Se "1", ricerca a due livelli: prima i documenti, poi i chunk dei RAG_HIER_DOCS documenti migliori.
+HIERARCHICAL_SEARCH = os.getenv("RAG_HIERARCHICAL", "0") == "1"
+HIER_DOCS = int(os.getenv("RAG_HIER_DOCS", "5"))
+# Chunk vicini (stesso documento) da unire a ogni contesto trovato; 0 = nessuna espansione.
+CONTEXT_EXPAND = int(os.getenv("RAG_CONTEXT_EXPAND", "0"))
+# Budget di latenza per /ask (ms): se il LLM non risponde in tempo si usa
+# la risposta estrattiva locale. 0 = nessun budget (si aspetta sempre il LLM).
+LATENCY_BUDGET_MS = float(os.getenv("RAG_LATENCY_BUDGET_MS", "8000"))
+# Circuit breaker del LLM: errori consecutivi prima di aprirlo e secondi prima di riprovare.
+LLM_BREAKER_FAILURES = int(os.getenv("RAG_LLM_BREAKER_FAILURES", "3"))
+LLM_BREAKER_RESET_S = float(os.getenv("RAG_LLM_BREAKER_RESET_S", "30"))
+# Richieste più lente di questa soglia (ms) finiscono nello slow log con il dettaglio degli span.
+SLOW_REQUEST_MS = float(os.getenv("RAG_SLOW_REQUEST_MS", "2000"))
+# File JSONL dello slow log; se vuoto le richieste lente vengono solo stampate.
+SLOW_LOG_PATH = os.getenv("RAG_SLOW_LOG_PATH", "")
+# Token per gli endpoint /admin (header 'X-Admin-Token'); se vuoto gli endpoint sono disabilitati.
+ADMIN_TOKEN = os.getenv("RAG_ADMIN_TOKEN", "")
+PROFILE_DIR = os.path.abspath(os.getenv("RAG_PROFILE_DIR", "data/profiles"))
+
+_jsonl_lock = threading.Lock()
+
+
+def append_jsonl(path: str, record: dict):
+    """
+    Appende il record (una riga JSON) al file indicato.
+    Non deve mai far fallire la richiesta: eventuali errori vengono solo stampati.
+    """
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    try:
+        with _jsonl_lock:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(line)
+    except OSError as e:
+        print(f"⚠️ Impossibile scrivere su {path}: {e}")
+
+
+def capture_request(record: dict):
+    """
+    Appende il record della richiesta al file di capture (formato JSONL).
+    """
+    if CAPTURE_PATH:
+        append_jsonl(CAPTURE_PATH, record)
+
+
+def log_slow_request(record: dict):
+    """
+    Registra una richiesta oltre SLOW_REQUEST_MS con span e dimensioni.
+    """
+    if record["total_ms"] < SLOW_REQUEST_MS:
+        return
+    tracing.log(f"🐢 Richiesta lenta: {record['total_ms']} ms, span={record['spans']}")
+    if SLOW_LOG_PATH:
+        append_jsonl(SLOW_LOG_PATH, record)
+
+
 # --- Funzione di Setup (presa da main.py) ---
 
 def ensure_vector_store(retriever: Retriever):
@@ -34,7 +104,7 @@ def ensure_vector_store(retriever: Retriever):
     else:
         print("⚠️ Nessun vector store trovato. Lo costruisco dai documenti CSV...")
         processor = DocumentProcessor()
-        docs = processor.load_documents_from_csv()
+        docs, doc_metadatas = processor.load_documents_with_metadata()
         
         if not docs:
             print("❌ Dati CSV non trovati o vuoti. L'indicizzazione non può continuare.")
@@ -43,10 +113,10 @@ def ensure_vector_store(retriever: Retriever):
 
         print(f"📄 Documenti caricati dal CSV: {len(docs)}")
 
-        chunks = processor.split_documents(docs)
+        chunks, chunk_records = processor.split_documents_with_metadata(docs, doc_metadatas)
         print(f"🔹 Chunk generati: {len(chunks)}")
 
-        retriever.build_index(chunks)
+        retriever.build_index(chunks, chunk_records)
         print("✅ Vector store creato.")
     return True # Segnala successo
 
@@ -63,13 +133,30 @@ app_ready = False
 
 try:
     print("Inizializzazione Retriever (FAISS)...")
-    retriever = Retriever()
+    retriever = Retriever(
+        hierarchical=HIERARCHICAL_SEARCH,
+        n_docs=HIER_DOCS,
+        expand_neighbors=CONTEXT_EXPAND,
+    )
     
-    print("Inizializzazione Generator (Gemini)...")
-    generator = Generator() # Questo controllerà la GOOGLE_API_KEY
+    # Il fallback estrattivo riusa il modello di embedding già caricato dal Retriever
+    fallback = ExtractiveBackend(retriever.model)
+    breaker = CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_RESET_S)
+    if USE_STUB_LLM:
+        print(f"Inizializzazione Generator (stub, latenza {STUB_LLM_LATENCY_S}s)...")
+        backend = StubBackend(latency_s=STUB_LLM_LATENCY_S, failure_rate=STUB_LLM_FAILURE_RATE)
+        generator = Generator(backend=backend, fallback=fallback, breaker=breaker)
+    else:
+        print("Inizializzazione Generator (Gemini)...")
+        # Questo controllerà la GOOGLE_API_KEY
+        generator = Generator(fallback=fallback, breaker=breaker)
     
     print("Verifica Vector Store...")
     app_ready = ensure_vector_store(retriever)
+
+    if app_ready and (HIERARCHICAL_SEARCH or CONTEXT_EXPAND > 0) and retriever.metadata is not None:
+        # Costruisce subito l'indice dei documenti, invece che alla prima richiesta
+        retriever.get_document_index()
     
     if app_ready:
         print("✅ Applicazione pronta a ricevere richieste.")
@@ -99,28 +186,140 @@ def ask():
     if not query:
         return jsonify({"error": "Nessuna domanda fornita."}), 400
 
+    # Filtro opzionale sui metadati dei chunk, in JSON (es. {"field": "answers"})
+    search_filter = None
+    if request.form.get('filter'):
+        try:
+            search_filter = json.loads(request.form['filter'])
+        except json.JSONDecodeError:
+            return jsonify({"error": "Il campo 'filter' non è un JSON valido."}), 400
+        if not isinstance(search_filter, dict):
+            return jsonify({"error": "Il campo 'filter' deve essere un oggetto JSON."}), 400
+
+    k = 3
+    trace, trace_token = tracing.start_trace(request.headers.get("X-Request-ID"))
+    g.request_id = trace.request_id
+    t_start = time.perf_counter()
+    deadline = time.monotonic() + LATENCY_BUDGET_MS / 1000 if LATENCY_BUDGET_MS > 0 else None
+    record = {
+        "request_id": trace.request_id,
+        "ts": time.time(),
+        "query": query,
+        "k": k,
+        "filter": search_filter,
+    }
+    contexts = []
+    answer = ""
+
     try:
         # 1. Retrieval
-        contexts = retriever.search(query, k=3)
+        try:
+            contexts = retriever.search(query, k=k, filter=search_filter)
+        except ValueError as e:
+            # Filtro non valido (o vector store senza metadati): errore del client
+            if search_filter is None:
+                raise
+            tracing.log(f"⚠️ Filtro non valido: {e}")
+            record["status"] = 400
+            record["error"] = str(e)
+            return jsonify({"error": str(e)}), 400
+        t_retrieval = time.perf_counter()
+        record["retrieval_ms"] = round((t_retrieval - t_start) * 1000, 2)
         
         if not contexts:
-            print(f"⚠️ Nessun contesto trovato per: '{query}'")
+            tracing.log(f"⚠️ Nessun contesto trovato per: '{query}'")
             # Possiamo decidere di rispondere comunque o solo con il LLM
             # Per ora, seguiamo il prompt originale
         
         # 2. Generation
-        answer = generator.generate_answer(query, contexts)
+        answer, backend = generator.generate(query, contexts, deadline=deadline)
+        record["generation_ms"] = round((time.perf_counter() - t_retrieval) * 1000, 2)
+        record["backend"] = backend
+        record["status"] = 200
 
         return jsonify({
             "query": query,
             "answer": answer,
+            "backend": backend,
             "contexts": contexts
         })
 
     except Exception as e:
-        print(f"Errore durante l'elaborazione della richiesta: {e}")
+        tracing.log(f"Errore durante l'elaborazione della richiesta: {e}")
+        record["status"] = 500
+        record["error"] = str(e)
         return jsonify({"error": str(e)}), 500
 
+    finally:
+        record["total_ms"] = round((time.perf_counter() - t_start) * 1000, 2)
+        record["spans"] = trace.spans_ms()
+        record["query_chars"] = len(query)
+        record["n_contexts"] = len(contexts)
+        record["contexts_chars"] = sum(len(c) for c in contexts)
+        record["answer_chars"] = len(answer)
+        capture_request(record)
+        log_slow_request(record)
+        tracing.end_trace(trace_token)
+
+
+@app.after_request
+def add_request_id(response):
+    """Restituisce il request ID al client, per correlarlo con i log."""
+    request_id = g.get("request_id")
+    if request_id:
+        response.headers["X-Request-ID"] = request_id
+    return response
+
+
+# --- Endpoints di amministrazione ---
+
+def admin_authorized() -> bool:
+    """Confronta (a tempo costante) l'header X-Admin-Token con RAG_ADMIN_TOKEN."""
+    token = request.headers.get("X-Admin-Token", "")
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+
+@app.route('/admin/profile', methods=['POST'])
+def admin_profile():
+    """
+    Avvia un profiling del worker che riceve la richiesta.
+    Parametri (form o query string): mode = 'wall' | 'alloc', seconds = durata.
+    Il risultato si scarica poi da /admin/profile/<nome>.
+
+    'wall' campiona gli stack di tutti i thread, anche di quelli in attesa
+    (socket, lock, executor del Generator): gli stack più frequenti dicono
+    dove si passa il tempo, non dove si consuma CPU.
+    """
+    if not admin_authorized():
+        return jsonify({"error": "Non autorizzato."}), 403
+
+    mode = request.values.get('mode', 'wall')
+    try:
+        seconds = float(request.values.get('seconds', '10'))
+        name = profiling.start_profile(mode, seconds, PROFILE_DIR)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 409
+    except OSError as e:
+        return jsonify({"error": f"Impossibile preparare la cartella dei profili: {e}"}), 500
+
+    return jsonify({
+        "profile": name,
+        "mode": mode,
+        "seconds": seconds,
+        "pid": os.getpid(),
+        "url": f"/admin/profile/{name}",
+    }), 202
+
+
+@app.route('/admin/profile/<name>', methods=['GET'])
+def admin_profile_result(name):
+    """Scarica un profilo completato (404 finché il profiling è in corso)."""
+    if not admin_authorized():
+        return jsonify({"error": "Non autorizzato."}), 403
+    return send_from_directory(PROFILE_DIR, name, mimetype="text/plain")
+
 
 if __name__ == '__main__':
     # Usato solo per test locale, in produzione useremo Gunicorn
@@ -22,13 +22,13 @@ def ensure_vector_store(retriever: Retriever):
     else:
         print("⚠️ Nessun vector store trovato. Lo costruisco dai documenti CSV...")
         processor = DocumentProcessor()
-        docs = processor.load_documents_from_csv()
+        docs, doc_metadatas = processor.load_documents_with_metadata()
         print(f"📄 Documenti caricati dal CSV: {len(docs)}")
 
-        chunks = processor.split_documents(docs)
+        chunks, chunk_records = processor.split_documents_with_metadata(docs, doc_metadatas)
         print(f"🔹 Chunk generati: {len(chunks)}")
 
-        retriever.build_index(chunks)
+        retriever.build_index(chunks, chunk_records)
         print("✅ Vector store creato.")
 
 
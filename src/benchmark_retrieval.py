@@ -0,0 +1,134 @@
+# src/benchmark_retrieval.py
+
+"""
+Benchmark: ricerca piatta (IndexFlatL2 su tutti i chunk) contro ricerca
+a due livelli (documenti -> chunk, vedi hierarchy.py).
+
+Non serve il modello di embedding: le query sono vettori di chunk
+esistenti con un po' di rumore.
+
+- Corpus sintetico (default): n_docs documenti, ognuno con chunk vicini al
+  proprio "centro", come i chunk di uno stesso testo.
+- Vector store reale (--store): usa indice FAISS e metadati salvati dal Retriever.
+
+Per ogni modalità riporta latenza per query (p50/p99), chunk esaminati,
+recall@k rispetto alla ricerca piatta e documenti distinti nei top-k.
+
+Esempio:
+    python src/benchmark_retrieval.py --docs 20000 --chunks-per-doc 10
+    python src/benchmark_retrieval.py --store data/processed/vector_store
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import faiss
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from hierarchy import DocumentIndex, index_vectors
+from metadata import ChunkMetadata
+
+
+def synthetic_corpus(n_docs: int, chunks_per_doc: int, d: int, seed: int = 0):
+    """
+    Ritorna (vettori dei chunk, doc_id) con chunk raggruppati attorno al centro del documento.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_docs, d)).astype(np.float32)
+    sizes = rng.integers(1, 2 * chunks_per_doc, size=n_docs)
+    doc_id = np.repeat(np.arange(n_docs), sizes)
+    vectors = centers[doc_id] + 0.5 * rng.standard_normal((len(doc_id), d)).astype(np.float32)
+    return vectors, doc_id
+
+
+def load_store(store_path: str):
+    """
+    Ritorna (vettori dei chunk, doc_id) da un vector store salvato dal Retriever.
+    """
+    index = faiss.read_index(os.path.join(store_path, "dmv.index"))
+    metadata = ChunkMetadata.load(os.path.join(store_path, "dmv_chunks_meta.npz"))
+    # Copia: la vista di index_vectors() non sopravvive all'indice locale
+    return np.array(index_vectors(index), copy=True), metadata.columns["doc_id"]
+
+
+def make_queries(vectors: np.ndarray, n_queries: int, seed: int = 1):
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(vectors), size=n_queries)
+    noise = 0.3 * vectors.std() * rng.standard_normal((n_queries, vectors.shape[1]))
+    return (vectors[picks] + noise).astype(np.float32)
+
+
+def run(vectors, doc_id, queries, k: int, n_docs_list):
+    flat = faiss.IndexFlatL2(vectors.shape[1])
+    flat.add(vectors)
+
+    t0 = time.perf_counter()
+    doc_index = DocumentIndex(flat, doc_id)
+    build_s = time.perf_counter() - t0
+    print(f"📄 Chunk: {len(vectors)}  Documenti: {doc_index.n_docs}  Dim: {vectors.shape[1]}")
+    print(f"⏱️ Costruzione indice documenti: {build_s * 1000:.1f} ms")
+
+    # Una query alla volta, come in /ask
+    flat_ids, flat_lat = [], []
+    for q in queries:
+        t = time.perf_counter()
+        _, ids = flat.search(q[None, :], k)
+        flat_lat.append(time.perf_counter() - t)
+        flat_ids.append(ids[0])
+
+    rows = [("flat", flat_lat, len(vectors), 1.0, _distinct_docs(flat_ids, doc_id))]
+
+    for n_docs in n_docs_list:
+        lat, scanned, hits, results = [], 0, 0, []
+        for q, truth in zip(queries, flat_ids):
+            t = time.perf_counter()
+            _, ids = doc_index.search(q[None, :], k, n_docs)
+            lat.append(time.perf_counter() - t)
+            scanned += doc_index.n_docs + len(doc_index.chunks_of(doc_index.top_documents(q[None, :], n_docs)))
+            hits += len(set(ids.tolist()) & set(truth.tolist()))
+            results.append(ids)
+        recall = hits / (k * len(queries))
+        rows.append((f"2-stage n_docs={n_docs}", lat, scanned / len(queries), recall, _distinct_docs(results, doc_id)))
+
+    print(f"\n{'modalità':<22}{'p50 ms':>10}{'p99 ms':>10}{'vettori/query':>16}{f'recall@{k}':>12}{'doc distinti':>14}")
+    for name, lat, scanned, recall, distinct in rows:
+        lat_ms = np.array(lat) * 1000
+        print(
+            f"{name:<22}{np.percentile(lat_ms, 50):>10.3f}{np.percentile(lat_ms, 99):>10.3f}"
+            f"{scanned:>16.0f}{recall:>12.3f}{distinct:>14.2f}"
+        )
+
+
+def _distinct_docs(results, doc_id) -> float:
+    """
+    Numero medio di documenti distinti nei top-k (più basso = contesti più coerenti).
+    """
+    return float(np.mean([len(set(doc_id[ids].tolist())) for ids in results]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ricerca piatta vs ricerca a due livelli.")
+    parser.add_argument("--store", help="Cartella del vector store (default: corpus sintetico)")
+    parser.add_argument("--docs", type=int, default=10000, help="Documenti del corpus sintetico")
+    parser.add_argument("--chunks-per-doc", type=int, default=10, help="Chunk medi per documento (sintetico)")
+    parser.add_argument("--dim", type=int, default=384, help="Dimensione dei vettori (sintetico)")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=3)
+    parser.add_argument("--n-docs", default="1,5,20", help="Documenti scelti al primo livello, es. '1,5,20'")
+    args = parser.parse_args(argv)
+
+    if args.store:
+        vectors, doc_id = load_store(args.store)
+    else:
+        vectors, doc_id = synthetic_corpus(args.docs, args.chunks_per_doc, args.dim)
+
+    queries = make_queries(vectors, args.queries)
+    run(vectors, doc_id, queries, args.k, [int(n) for n in args.n_docs.split(",")])
+
+
+if __name__ == "__main__":
+    main()
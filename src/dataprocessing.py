@@ -8,6 +8,16 @@ DATA_DIR = "data"
 CSV_NAME = "dmv_data_filtrato.csv"
 CSV_PATH = os.path.join(DATA_DIR, CSV_NAME)
 
+# Campi del CSV che compongono il testo di un documento, con la relativa intestazione
+DOCUMENT_FIELDS = [
+    ("document", ""),
+    ("ground_truth_ctx", "Ground truth context:\n"),
+    ("ctxs", "Retrieved contexts:\n"),
+    ("messages", "Messages:\n"),
+    ("answers", "Answer:\n"),
+]
+PART_SEPARATOR = "\n\n"
+
 class DocumentProcessor:
     '''
     Classe per caricare e processare i documenti
@@ -19,17 +29,31 @@ class DocumentProcessor:
         '''
         self.text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap
+            chunk_overlap=chunk_overlap,
+            add_start_index=True,  # serve per sapere da quale campo viene ogni chunk
         )
 
     def load_documents_from_csv(self, csv_path=CSV_PATH): # Usa la variabile
+        """
+        Carica i documenti (solo testo) dal CSV.
+        """
+        documents, _ = self.load_documents_with_metadata(csv_path)
+        return documents
+
+    def load_documents_with_metadata(self, csv_path=CSV_PATH):
+        """
+        Carica i documenti dal CSV insieme ai loro metadati.
+        Ritorna (documents, metadatas) dove metadatas[i] contiene:
+        - source_row: riga del CSV (0-based, esclusa l'intestazione)
+        - fields: lista di (nome campo, offset di inizio, offset di fine) nel testo
+        """
         
         # Assicurati che la cartella dati esista prima di leggere
         os.makedirs(DATA_DIR, exist_ok=True)
         
         if not os.path.exists(csv_path):
              print(f"Attenzione: file {csv_path} non ancora esistente. Verrà creato dallo script di setup.")
-             return [] # Ritorna lista vuota se il file non c'è
+             return [], [] # Ritorna liste vuote se il file non c'è
 
         try:
             csv.field_size_limit(50_000_000)
@@ -37,32 +61,32 @@ class DocumentProcessor:
             csv.field_size_limit(10_000_000)
 
         documents: list[str] = []
+        metadatas: list[dict] = []
         visti: set[str] = set()
 
         with open(csv_path, "r", encoding="utf-8") as f:
             reader = csv.DictReader(f)
 
-            for row in reader:
+            for row_number, row in enumerate(reader):
                 parti_testo: list[str] = []
-                if row.get("document"):
-                    parti_testo.append(row["document"].strip())
-                if row.get("ground_truth_ctx"):
-                    parti_testo.append("Ground truth context:\n" + row["ground_truth_ctx"].strip())
-                if row.get("ctxs"):
-                    parti_testo.append("Retrieved contexts:\n" + row["ctxs"].strip())
-                if row.get("messages"):
-                    parti_testo.append("Messages:\n" + row["messages"].strip())
-                if row.get("answers"):
-                    parti_testo.append("Answer:\n" + row["answers"].strip())
-
-                testo_documento = "\n\n".join(parti_testo)
+                campi: list[tuple[str, int, int]] = []
+                offset = 0
+                for campo, intestazione in DOCUMENT_FIELDS:
+                    if row.get(campo):
+                        parte = intestazione + row[campo].strip()
+                        campi.append((campo, offset, offset + len(parte)))
+                        parti_testo.append(parte)
+                        offset += len(parte) + len(PART_SEPARATOR)
+
+                testo_documento = PART_SEPARATOR.join(parti_testo)
                 if not testo_documento:
                     continue
                 if testo_documento not in visti:
                     visti.add(testo_documento)
                     documents.append(testo_documento)
+                    metadatas.append({"source_row": row_number, "fields": campi})
 
-        return documents
+        return documents, metadatas
 
     def split_documents(self, documents_text):
         """
@@ -71,6 +95,45 @@ class DocumentProcessor:
         chunks = self.text_splitter.create_documents(documents_text)
         return [chunk.page_content for chunk in chunks]
 
+    def split_documents_with_metadata(self, documents_text, metadatas):
+        """
+        Divide i documenti in chunks e ritorna (chunks, chunk_records), dove
+        chunk_records[i] = {doc_id, source_row, fields, position, start_index} per il chunk i
+        (start_index = offset del chunk nel testo del documento).
+        'fields' elenca tutti i campi del CSV che il chunk tocca anche solo in
+        parte (un chunk può contenere la fine di 'document' e un breve 'answers').
+        """
+        chunks = self.text_splitter.create_documents(
+            documents_text,
+            metadatas=[{"doc_id": i} for i in range(len(documents_text))],
+        )
+
+        testi: list[str] = []
+        records: list[dict] = []
+        position = 0
+        previous_doc = -1
+        for chunk in chunks:
+            doc_id = chunk.metadata["doc_id"]
+            position = position + 1 if doc_id == previous_doc else 0
+            previous_doc = doc_id
+
+            doc_meta = metadatas[doc_id]
+            start = max(chunk.metadata.get("start_index", 0), 0)
+            end = start + len(chunk.page_content)
+            # Campi il cui intervallo [inizio, fine) si sovrappone a [start, end)
+            fields = [nome for nome, inizio, fine in doc_meta["fields"] if inizio < end and fine > start]
+
+            testi.append(chunk.page_content)
+            records.append({
+                "doc_id": doc_id,
+                "source_row": doc_meta["source_row"],
+                "fields": fields,
+                "position": position,
+                "start_index": start,
+            })
+
+        return testi, records
+
 '''
 # Esecuzione non necessaria qui, gestita dal server
 '''
\ No newline at end of file
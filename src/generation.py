@@ -1,33 +1,35 @@
 from dotenv import load_dotenv
 load_dotenv()
 
+import contextvars
 import os
+from abc import ABC, abstractmethod
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from typing import List
 import google.generativeai as genai
 
+try:
+    from src.tracing import span, log
+except ImportError:  # eseguito con 'src' nel path (es. evaluate.py)
+    from tracing import span, log
 
-class Generator:
-    """
-    Gestisce la generazione della risposta usando il modello Gemini 2.0 Flash via API.
 
-    Non serve scaricare nulla in locale:
-    basta avere la chiave API impostata in GOOGLE_API_KEY.
-    """
+# Separatore di frasi per il backend estrattivo
+_SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+|\n+")
 
-    def __init__(self, model_name: str = "gemini-2.0-flash"):
-        """
-        Inizializza il client di Gemini.
-        """
-        api_key = os.getenv("GOOGLE_API_KEY")
-        if not api_key:
-            raise EnvironmentError(
-                "❌ GOOGLE_API_KEY non trovata. "
-                "Imposta la variabile d'ambiente prima di usare il Generator."
-            )
 
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel(model_name)
-        self.model_name = model_name
+class GeneratorBackend(ABC):
+    """
+    Interfaccia comune dei backend di generazione usati da Generator.
+    Ogni backend ha un 'name' (riportato nella risposta di /ask) e implementa
+    generate_answer(query, context_chunks, timeout_s=None) -> str.
+    """
+
+    name = "base"
 
     def _build_prompt(self, query: str, context_chunks: List[str]) -> str:
         """
@@ -47,11 +49,49 @@ class Generator:
 
         return prompt
 
-    def generate_answer(self, query: str, context_chunks: List[str]) -> str:
+    @abstractmethod
+    def generate_answer(self, query: str, context_chunks: List[str], timeout_s: float = None) -> str:
+        """
+        Genera la risposta. timeout_s (se indicato) è il tempo massimo per
+        eventuali chiamate di rete: scaduto, il backend deve sollevare un'eccezione.
+        """
+
+
+class GeminiBackend(GeneratorBackend):
+    """
+    Genera la risposta usando il modello Gemini 2.0 Flash via API.
+
+    Non serve scaricare nulla in locale:
+    basta avere la chiave API impostata in GOOGLE_API_KEY.
+    """
+
+    name = "gemini"
+
+    def __init__(self, model_name: str = "gemini-2.0-flash"):
+        """
+        Inizializza il client di Gemini.
+        """
+        api_key = os.getenv("GOOGLE_API_KEY")
+        if not api_key:
+            raise EnvironmentError(
+                "❌ GOOGLE_API_KEY non trovata. "
+                "Imposta la variabile d'ambiente prima di usare il Generator."
+            )
+
+        genai.configure(api_key=api_key)
+        self.model = genai.GenerativeModel(model_name)
+        self.model_name = model_name
+
+    def generate_answer(self, query: str, context_chunks: List[str], timeout_s: float = None) -> str:
         """
         Genera una risposta usando Gemini (modello via API).
         """
-        prompt = self._build_prompt(query, context_chunks)
+        with span("prompt_build"):
+            prompt = self._build_prompt(query, context_chunks)
+
+        # Con un timeout la chiamata termina anche se abbandonata dal Generator,
+        # liberando il thread del pool
+        request_options = {"timeout": timeout_s} if timeout_s is not None else None
 
         # Chiamata al modello Gemini
         response = self.model.generate_content(
@@ -62,6 +102,7 @@ class Generator:
                 top_p=0.9,
                 top_k=40,
             ),
+            request_options=request_options,
         )
 
         # Estraggo il testo
@@ -71,6 +112,230 @@ class Generator:
             return "⚠️ Nessuna risposta generata dal modello."
 
 
+class StubBackend(GeneratorBackend):
+    """
+    Backend finto da usare nei test di carico (replay) al posto di Gemini.
+
+    Non chiama nessuna API: attende una latenza configurabile e
+    restituisce una risposta costruita dai contesti, così il server
+    può essere messo sotto carico senza consumare quota né GOOGLE_API_KEY.
+    Con failure_rate > 0 simula anche errori, per provare il fallback.
+    """
+
+    name = "stub"
+
+    def __init__(self, latency_s: float = 0.5, jitter_s: float = 0.0, failure_rate: float = 0.0):
+        """
+        Imposta la latenza simulata (in secondi), un eventuale jitter uniforme
+        e la probabilità di errore.
+        """
+        self.model_name = "stub"
+        self.latency_s = latency_s
+        self.jitter_s = jitter_s
+        self.failure_rate = failure_rate
+
+    def generate_answer(self, query: str, context_chunks: List[str], timeout_s: float = None) -> str:
+        """
+        Simula la chiamata al LLM: costruisce comunque il prompt
+        (come farebbe Gemini) e dorme per la latenza configurata,
+        al massimo timeout_s secondi.
+        """
+        with span("prompt_build"):
+            prompt = self._build_prompt(query, context_chunks)
+        latency_s = max(0.0, self.latency_s + random.uniform(-self.jitter_s, self.jitter_s))
+        if timeout_s is not None and latency_s > timeout_s:
+            time.sleep(max(0.0, timeout_s))
+            raise TimeoutError("Timeout simulato dallo stub LLM.")
+        time.sleep(latency_s)
+        if random.random() < self.failure_rate:
+            raise RuntimeError("Errore simulato dallo stub LLM.")
+        return f"[stub] {len(context_chunks)} contesti, prompt di {len(prompt)} caratteri."
+
+
+class ExtractiveBackend(GeneratorBackend):
+    """
+    Risposta estrattiva locale: sceglie dai contesti le frasi più simili
+    alla domanda usando il modello di embedding già caricato dal Retriever.
+    Nessuna chiamata di rete: usato come fallback quando il LLM è lento o fuori uso.
+    """
+
+    name = "extractive"
+
+    def __init__(self, embedding_model, n_sentences: int = 3, max_sentences: int = 200):
+        """
+        embedding_model: un SentenceTransformer (es. retriever.model).
+        max_sentences limita le frasi da codificare, per tenere bassa la latenza.
+        """
+        self.model = embedding_model
+        self.n_sentences = n_sentences
+        self.max_sentences = max_sentences
+
+    def _split_sentences(self, context_chunks: List[str]) -> List[str]:
+        sentences: List[str] = []
+        for chunk in context_chunks:
+            for sentence in _SENTENCE_SPLIT.split(chunk):
+                sentence = sentence.strip()
+                if len(sentence.split()) >= 3 and sentence not in sentences:
+                    sentences.append(sentence)
+                    if len(sentences) >= self.max_sentences:
+                        return sentences
+        return sentences
+
+    def generate_answer(self, query: str, context_chunks: List[str], timeout_s: float = None) -> str:
+        """
+        Ritorna le n_sentences frasi più rilevanti, nell'ordine in cui compaiono nei contesti.
+        """
+        sentences = self._split_sentences(context_chunks)
+        if not sentences:
+            return "⚠️ Non ho informazioni sufficienti per rispondere."
+
+        embeddings = self.model.encode(
+            [query] + sentences,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+        )
+        scores = embeddings[1:] @ embeddings[0]
+        best = sorted(scores.argsort()[::-1][: self.n_sentences])
+        return " ".join(sentences[i] for i in best)
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker semplice per il backend principale.
+
+    Dopo 'failure_threshold' errori consecutivi il circuito si apre e le
+    richieste vanno direttamente al fallback per 'reset_timeout_s' secondi;
+    poi una sola richiesta di prova (half-open) decide se richiuderlo.
+    """
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout_s: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_s = reset_timeout_s
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """
+        True se la richiesta può usare il backend principale.
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout_s or self._trial_in_progress:
+                return False
+            self._trial_in_progress = True  # half-open: lascia passare una richiesta
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_progress = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_progress = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class Generator:
+    """
+    Genera la risposta con un backend principale (di default Gemini) e,
+    se configurato, un backend di fallback (es. ExtractiveBackend).
+
+    Il fallback viene usato quando il circuit breaker è aperto, quando il
+    backend principale fallisce o quando la deadline della richiesta sta per
+    scadere: così la latenza resta limitata anche se il LLM è lento.
+    """
+
+    def __init__(
+        self,
+        model_name: str = "gemini-2.0-flash",
+        backend: GeneratorBackend = None,
+        fallback: GeneratorBackend = None,
+        breaker: CircuitBreaker = None,
+        fallback_reserve_s: float = 0.3,
+        min_primary_s: float = 0.5,
+        max_workers: int = 8,
+    ):
+        """
+        Senza 'backend' inizializza Gemini (richiede GOOGLE_API_KEY).
+        fallback_reserve_s è il tempo lasciato al fallback prima della deadline.
+        min_primary_s è il tempo minimo per tentare il backend principale: con meno
+        si passa subito al fallback, senza contare un fallimento nel circuit breaker.
+        """
+        self.backend = backend or GeminiBackend(model_name)
+        self.fallback = fallback
+        self.breaker = breaker or CircuitBreaker()
+        self.fallback_reserve_s = fallback_reserve_s
+        self.min_primary_s = min_primary_s
+        self.model_name = getattr(self.backend, "model_name", self.backend.name)
+        # Le chiamate al backend principale girano qui, per poterle abbandonare alla deadline
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rag-llm")
+
+    def _run_primary(self, query: str, context_chunks: List[str], call_deadline: float = None) -> str:
+        # Il timeout si calcola quando la chiamata parte davvero: il tempo
+        # passato in coda nel pool è già stato consumato
+        timeout_s = None
+        if call_deadline is not None:
+            timeout_s = call_deadline - time.monotonic()
+            if timeout_s <= 0:
+                raise TimeoutError("Deadline scaduta prima dell'esecuzione.")
+        return self.backend.generate_answer(query, context_chunks, timeout_s)
+
+    def _call_primary(self, query: str, context_chunks: List[str], timeout_s: float = None) -> str:
+        call_deadline = time.monotonic() + timeout_s if timeout_s is not None else None
+        # copy_context() propaga la trace corrente (request ID + span) al thread del pool
+        ctx = contextvars.copy_context()
+        future = self._executor.submit(ctx.run, self._run_primary, query, context_chunks, call_deadline)
+        return future.result(timeout=timeout_s)
+
+    def generate(self, query: str, context_chunks: List[str], deadline: float = None):
+        """
+        Genera la risposta rispettando la deadline (time.monotonic() assoluto, opzionale).
+        Ritorna (risposta, nome del backend che l'ha prodotta).
+        """
+        if self.fallback is None:
+            with span("llm_call"):
+                return self.backend.generate_answer(query, context_chunks), self.backend.name
+
+        timeout_s = None
+        if deadline is not None:
+            timeout_s = deadline - time.monotonic() - self.fallback_reserve_s
+
+        if timeout_s is not None and timeout_s < self.min_primary_s:
+            # Un timeout con così poco tempo non direbbe nulla sulla salute del backend
+            log(f"⏱️ Budget di latenza insufficiente: uso il backend '{self.fallback.name}'.")
+        elif not self.breaker.allow():
+            log(f"🔌 Circuit breaker aperto: uso il backend '{self.fallback.name}'.")
+        else:
+            try:
+                with span("llm_call"):
+                    answer = self._call_primary(query, context_chunks, timeout_s)
+                self.breaker.record_success()
+                return answer, self.backend.name
+            except FutureTimeoutError:
+                self.breaker.record_failure()
+                log(f"⏱️ '{self.backend.name}' oltre la deadline: uso il backend '{self.fallback.name}'.")
+            except Exception as e:
+                self.breaker.record_failure()
+                log(f"❌ Errore del backend '{self.backend.name}' ({e}): uso '{self.fallback.name}'.")
+
+        with span("fallback"):
+            return self.fallback.generate_answer(query, context_chunks), self.fallback.name
+
+    def generate_answer(self, query: str, context_chunks: List[str]) -> str:
+        """
+        Genera una risposta (solo il testo, senza deadline).
+        """
+        answer, _ = self.generate(query, context_chunks)
+        return answer
+
+
 if __name__ == "__main__":
     # Esempio dimostrativo
     generator = Generator()
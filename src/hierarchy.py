@@ -0,0 +1,130 @@
+# src/hierarchy.py
+
+"""
+Indice a due livelli: prima i documenti, poi i chunk dei documenti scelti.
+
+Ogni documento è rappresentato dalla media dei vettori dei suoi chunk.
+La ricerca:
+1. cerca i top-n documenti nell'indice dei documenti (molto più piccolo);
+2. calcola le distanze solo sui chunk di quei documenti.
+
+Il lavoro per query passa da O(n_chunk) a O(n_doc + chunk dei documenti
+scelti), e i risultati tendono a concentrarsi sui documenti più pertinenti.
+"""
+
+import faiss
+import numpy as np
+
+
+def index_vectors(index) -> np.ndarray:
+    """
+    Ritorna i vettori dell'indice FAISS come matrice (n, d).
+    Per IndexFlat è una vista senza copia; per altri indici li ricostruisce.
+
+    Attenzione: la vista punta alla memoria dell'indice e non lo tiene in vita.
+    Non deve sopravvivere all'indice (né a un suo add/reset): se serve oltre,
+    copiarla con np.array(..., copy=True).
+    """
+    n, d = index.ntotal, index.d
+    if isinstance(index, faiss.IndexFlat):
+        return faiss.rev_swig_ptr(index.get_xb(), n * d).reshape(n, d)
+    return index.reconstruct_n(0, n)
+
+
+class DocumentIndex:
+    """
+    Indice dei documenti costruito dall'indice dei chunk e dal loro doc_id.
+    """
+
+    def __init__(self, chunk_index, doc_id: np.ndarray):
+        """
+        chunk_index: indice FAISS dei chunk; i suoi vettori sono letti con
+        index_vectors() senza copia e l'indice resta referenziato finché
+        l'oggetto è in uso (non va modificato con add/reset nel frattempo).
+        doc_id: documento di appartenenza di ogni chunk.
+        """
+        self._owner = chunk_index
+        self.chunk_vectors = chunk_vectors = index_vectors(chunk_index)
+        doc_id = np.asarray(doc_id, dtype=np.int64)
+
+        # Chunk raggruppati per documento (formato CSR): i chunk del documento j
+        # sono chunk_order[doc_starts[j]:doc_starts[j + 1]], in ordine di ID
+        # (= ordine di posizione nel documento).
+        self.chunk_order = np.argsort(doc_id, kind="stable")
+        counts = np.bincount(doc_id)
+        self.doc_starts = np.concatenate([[0], np.cumsum(counts)])
+        self.doc_of_chunk = doc_id
+        # Posizione di ogni chunk dentro self.chunk_order (per i vicini)
+        self.rank_of_chunk = np.empty_like(self.chunk_order)
+        self.rank_of_chunk[self.chunk_order] = np.arange(len(self.chunk_order))
+
+        # Vettore del documento = media dei vettori dei suoi chunk
+        d = chunk_vectors.shape[1]
+        sums = np.zeros((len(counts), d), dtype=np.float32)
+        nonempty = counts > 0
+        sums[nonempty] = np.add.reduceat(
+            chunk_vectors[self.chunk_order], self.doc_starts[:-1][nonempty], axis=0
+        )
+        self.doc_vectors = sums / np.maximum(counts, 1)[:, None].astype(np.float32)
+
+        self.doc_index = faiss.IndexFlatL2(d)
+        self.doc_index.add(self.doc_vectors)
+
+    @property
+    def n_docs(self) -> int:
+        return self.doc_index.ntotal
+
+    def chunks_of(self, doc_ids) -> np.ndarray:
+        """
+        ID dei chunk appartenenti ai documenti indicati.
+        """
+        parts = [self.chunk_order[self.doc_starts[j]:self.doc_starts[j + 1]] for j in doc_ids]
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+
+    def top_documents(self, query_vec: np.ndarray, n_docs: int, allowed_docs=None) -> np.ndarray:
+        """
+        I n_docs documenti più vicini alla query (eventualmente solo tra allowed_docs).
+        """
+        params = None
+        if allowed_docs is not None:
+            selector = faiss.IDSelectorBatch(np.asarray(allowed_docs, dtype=np.int64))
+            params = faiss.SearchParameters(sel=selector)
+            n_docs = min(n_docs, len(allowed_docs))
+        n_docs = min(n_docs, self.n_docs)
+        if n_docs == 0:
+            return np.empty(0, dtype=np.int64)
+        _, doc_ids = self.doc_index.search(query_vec, n_docs, params=params)
+        return doc_ids[0][doc_ids[0] >= 0]
+
+    def search(self, query_vec: np.ndarray, k: int, n_docs: int, chunk_mask=None):
+        """
+        Ricerca a due livelli. Ritorna (distanze, ID dei chunk) dei k migliori.
+
+        chunk_mask (opzionale, array bool per chunk) limita i chunk ammessi:
+        i documenti senza chunk ammessi vengono esclusi già al primo livello.
+        """
+        allowed_docs = None
+        if chunk_mask is not None:
+            allowed_docs = np.unique(self.doc_of_chunk[chunk_mask])
+
+        doc_ids = self.top_documents(query_vec, n_docs, allowed_docs)
+        candidates = self.chunks_of(doc_ids)
+        if chunk_mask is not None:
+            candidates = candidates[chunk_mask[candidates]]
+        if len(candidates) == 0:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+
+        k = min(k, len(candidates))
+        distances, local_ids = faiss.knn(query_vec, self.chunk_vectors[candidates], k)
+        return distances[0], candidates[local_ids[0]]
+
+    def neighbors(self, chunk_id: int, window: int) -> np.ndarray:
+        """
+        Il chunk e fino a 'window' chunk prima e dopo di lui nello stesso documento,
+        in ordine di posizione.
+        """
+        j = self.doc_of_chunk[chunk_id]
+        rank = self.rank_of_chunk[chunk_id]
+        lo = max(self.doc_starts[j], rank - window)
+        hi = min(self.doc_starts[j + 1], rank + window + 1)
+        return self.chunk_order[lo:hi]
@@ -0,0 +1,187 @@
+# src/metadata.py
+
+"""
+Metadati dei chunk in formato colonnare + bitmap index per i filtri.
+
+Ogni chunk i ha: doc_id, source_row (riga CSV), field_mask (i campi del CSV
+che il chunk contiene, un bit per campo), position (indice del chunk dentro
+il documento), start_index (offset del chunk nel testo del documento, per
+riunire chunk consecutivi). Le colonne sono array numpy (5 interi per chunk)
+salvati in un .npz accanto all'indice FAISS.
+
+I filtri vengono valutati direttamente su bitmap "packed" (1 bit per chunk,
+ordine dei bit little-endian), lo stesso formato di faiss.IDSelectorBitmap:
+il risultato si passa così com'è alla ricerca FAISS, senza over-fetch.
+"""
+
+import numpy as np
+
+# Colonne su cui si può filtrare ('field' usa la colonna field_mask)
+COLUMNS = ("doc_id", "source_row", "field", "position")
+# field_mask è un uint8: al massimo 8 campi distinti
+MAX_FIELDS = 8
+# Le colonne con al massimo questi valori distinti hanno una bitmap precalcolata
+# per ogni valore; le altre vengono filtrate con un confronto vettoriale.
+MAX_BITMAP_CARDINALITY = 256
+
+
+class ChunkMetadata:
+    """
+    Metadati colonnari dei chunk, allineati agli ID dell'indice FAISS.
+    """
+
+    def __init__(self, doc_id, source_row, field_mask, position, start_index, field_names):
+        self.columns = {
+            "doc_id": np.asarray(doc_id, dtype=np.int32),
+            "source_row": np.asarray(source_row, dtype=np.int32),
+            "field_mask": np.asarray(field_mask, dtype=np.uint8),
+            "position": np.asarray(position, dtype=np.int32),
+            "start_index": np.asarray(start_index, dtype=np.int32),
+        }
+        self.field_names = list(field_names)
+        # colonna -> {valore: bitmap packed}, costruite alla prima richiesta
+        # (None = colonna con troppi valori distinti, niente bitmap)
+        self._bitmaps: dict = {}
+
+    def __len__(self):
+        return len(self.columns["doc_id"])
+
+    @classmethod
+    def from_records(cls, records: list[dict]):
+        """
+        Costruisce le colonne da una lista di dict (uno per chunk),
+        come quella ritornata da DocumentProcessor.split_documents_with_metadata().
+        """
+        field_names = sorted({name for r in records for name in r["fields"]})
+        if len(field_names) > MAX_FIELDS:
+            raise ValueError(f"Troppi campi distinti ({len(field_names)}): massimo {MAX_FIELDS}.")
+        field_codes = {name: code for code, name in enumerate(field_names)}
+        return cls(
+            doc_id=[r["doc_id"] for r in records],
+            source_row=[r["source_row"] for r in records],
+            field_mask=[sum(1 << field_codes[name] for name in set(r["fields"])) for r in records],
+            position=[r["position"] for r in records],
+            start_index=[r["start_index"] for r in records],
+            field_names=field_names,
+        )
+
+    def save(self, path: str):
+        np.savez_compressed(path, field_names=np.array(self.field_names), **self.columns)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as data:
+            return cls(
+                doc_id=data["doc_id"],
+                source_row=data["source_row"],
+                field_mask=data["field_mask"],
+                position=data["position"],
+                start_index=data["start_index"],
+                field_names=[str(name) for name in data["field_names"]],
+            )
+
+    def record(self, i: int) -> dict:
+        """
+        Metadati del chunk i come dict (con i nomi dei campi, non la bitmask).
+        """
+        mask = int(self.columns["field_mask"][i])
+        return {
+            "doc_id": int(self.columns["doc_id"][i]),
+            "source_row": int(self.columns["source_row"][i]),
+            "fields": [name for code, name in enumerate(self.field_names) if mask >> code & 1],
+            "position": int(self.columns["position"][i]),
+            "start_index": int(self.columns["start_index"][i]),
+        }
+
+    def _pack(self, mask) -> np.ndarray:
+        return np.packbits(mask, bitorder="little")
+
+    def _column_bitmap(self, column: str, values: list[int]) -> np.ndarray:
+        """
+        Bitmap dei chunk in cui 'column' assume uno dei 'values'.
+        """
+        if column == "field":
+            return self._field_bitmap(values)
+
+        col = self.columns[column]
+        if column not in self._bitmaps:
+            distinct = np.unique(col)
+            if len(distinct) <= MAX_BITMAP_CARDINALITY:
+                self._bitmaps[column] = {int(v): self._pack(col == v) for v in distinct}
+            else:
+                self._bitmaps[column] = None
+        bitmaps = self._bitmaps[column]
+
+        if bitmaps is None:
+            return self._pack(np.isin(col, values))
+
+        result = np.zeros((len(self) + 7) // 8, dtype=np.uint8)
+        for v in values:
+            if v in bitmaps:
+                result |= bitmaps[v]
+        return result
+
+    def _field_bitmap(self, codes: list[int]) -> np.ndarray:
+        """
+        Bitmap dei chunk che contengono almeno uno dei campi indicati (codici).
+        Una bitmap per campo, costruita alla prima richiesta.
+        """
+        if "field" not in self._bitmaps:
+            mask = self.columns["field_mask"]
+            self._bitmaps["field"] = {
+                code: self._pack((mask >> code) & 1) for code in range(len(self.field_names))
+            }
+        bitmaps = self._bitmaps["field"]
+
+        result = np.zeros((len(self) + 7) // 8, dtype=np.uint8)
+        for code in codes:
+            result |= bitmaps[code]
+        return result
+
+    def filter_bitmap(self, filter: dict):
+        """
+        Traduce un filtro in bitmap. Ritorna (bitmap packed, numero di chunk selezionati).
+
+        Il filtro è un dict {colonna: valore o lista di valori}: i valori della
+        stessa colonna sono in OR, colonne diverse sono in AND. Per 'field'
+        si usano i nomi dei campi del CSV (es. {"field": ["answers", "document"]}):
+        un chunk corrisponde se contiene anche solo in parte uno di quei campi.
+        """
+        if not isinstance(filter, dict):
+            raise ValueError("Il filtro deve essere un dict {colonna: valore o lista di valori}.")
+        unknown = set(filter) - set(COLUMNS)
+        if unknown:
+            raise ValueError(f"Colonne di filtro non valide: {sorted(unknown)}. Ammesse: {list(COLUMNS)}")
+
+        bitmap = np.full((len(self) + 7) // 8, 0xFF, dtype=np.uint8)
+        for column, values in filter.items():
+            values = _filter_values(column, values)
+            if column == "field":
+                codes = {name: code for code, name in enumerate(self.field_names)}
+                values = [codes[v] for v in values if v in codes]
+            bitmap &= self._column_bitmap(column, values)
+
+        # Azzera i bit di padding dell'ultimo byte
+        extra = len(bitmap) * 8 - len(self)
+        if extra and len(bitmap):
+            bitmap[-1] &= 0xFF >> extra
+        count = int(np.unpackbits(bitmap, bitorder="little").sum())
+        return bitmap, count
+
+
+def _filter_values(column: str, values) -> list:
+    """
+    Normalizza i valori di un filtro in lista, controllandone il tipo:
+    stringhe per 'field', interi per le altre colonne (bool esclusi).
+    Solleva ValueError per qualsiasi valore non valido (None, float, liste annidate, ...).
+    """
+    expected = str if column == "field" else int
+    if not isinstance(values, (list, tuple)):
+        values = [values]
+    for v in values:
+        if not isinstance(v, expected) or isinstance(v, bool):
+            raise ValueError(
+                f"Valore non valido per '{column}': {v!r} "
+                f"(atteso {'una stringa' if expected is str else 'un intero'} o una lista)."
+            )
+    return list(values)
@@ -0,0 +1,129 @@
+# src/profiling.py
+
+"""
+Profiling on-demand di un worker in esecuzione, senza dipendenze esterne.
+
+- wall:  campionatore che legge periodicamente gli stack di tutti i thread
+         (sys._current_frames) e li aggrega in formato "collapsed"
+         (una riga per stack: "f1;f2;f3 N"), compatibile con flamegraph.pl
+         e speedscope. È tempo "wall-clock", non CPU: anche i thread fermi
+         (in attesa di una lock, del socket, della coda dell'executor)
+         vengono campionati, con lo stack della chiamata in cui aspettano.
+- alloc: snapshot tracemalloc delle allocazioni avvenute nella finestra,
+         raggruppate per riga di codice.
+
+Il profiling gira in un thread in background e scrive il risultato su file,
+così il worker continua a servire richieste mentre viene campionato.
+"""
+
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+DEFAULT_INTERVAL_S = 0.005
+MAX_DURATION_S = 120
+TOP_ALLOCATIONS = 50
+
+_running_lock = threading.Lock()
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def sample_wall(duration_s: float, interval_s: float = DEFAULT_INTERVAL_S) -> str:
+    """
+    Campiona gli stack di tutti gli altri thread per duration_s secondi,
+    che stiano lavorando o aspettando.
+    Ritorna gli stack aggregati in formato collapsed, ordinati per frequenza.
+    """
+    me = threading.get_ident()
+    stacks: Counter = Counter()
+    n_samples = 0
+    deadline = time.monotonic() + duration_s
+
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            stacks[";".join(reversed(labels))] += 1
+        n_samples += 1
+        time.sleep(interval_s)
+
+    lines = [f"# wall samples={n_samples} interval_s={interval_s} duration_s={duration_s}"]
+    lines += [f"{stack} {count}" for stack, count in stacks.most_common()]
+    return "\n".join(lines) + "\n"
+
+
+def snapshot_allocations(duration_s: float, top: int = TOP_ALLOCATIONS) -> str:
+    """
+    Traccia le allocazioni per duration_s secondi e ritorna le righe
+    di codice che hanno allocato di più (ancora vive a fine finestra).
+    """
+    already_tracing = tracemalloc.is_tracing()
+    if not already_tracing:
+        tracemalloc.start(25)
+    try:
+        before = tracemalloc.take_snapshot()
+        time.sleep(duration_s)
+        after = tracemalloc.take_snapshot()
+    finally:
+        if not already_tracing:
+            tracemalloc.stop()
+
+    stats = after.compare_to(before, "lineno")
+    lines = [f"# alloc duration_s={duration_s} top={top}"]
+    lines += [str(stat) for stat in stats[:top]]
+    return "\n".join(lines) + "\n"
+
+
+def start_profile(mode: str, duration_s: float, output_dir: str) -> str:
+    """
+    Avvia un profiling in background e ritorna il nome del file di output.
+
+    Solleva ValueError per parametri non validi, RuntimeError se
+    un profiling è già in corso in questo processo e OSError se non si
+    può creare la cartella di output.
+    """
+    if mode not in ("wall", "alloc"):
+        raise ValueError("mode deve essere 'wall' oppure 'alloc'.")
+    if not 0 < duration_s <= MAX_DURATION_S:
+        raise ValueError(f"seconds deve essere tra 0 e {MAX_DURATION_S}.")
+    os.makedirs(output_dir, exist_ok=True)
+    if not _running_lock.acquire(blocking=False):
+        raise RuntimeError("Profiling già in corso su questo worker.")
+
+    name = f"{mode}-{os.getpid()}-{int(time.time())}.txt"
+    path = os.path.join(output_dir, name)
+
+    def run():
+        try:
+            if mode == "wall":
+                result = sample_wall(duration_s)
+            else:
+                result = snapshot_allocations(duration_s)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(result)
+            os.replace(tmp_path, path)
+            print(f"✅ Profilo {mode} salvato in: {path}")
+        except Exception as e:
+            print(f"❌ Errore durante il profiling {mode}: {e}")
+        finally:
+            _running_lock.release()
+
+    try:
+        threading.Thread(target=run, name=f"rag-profiler-{mode}", daemon=True).start()
+    except Exception:
+        # Il thread non è partito: nessuno rilascerebbe il lock
+        _running_lock.release()
+        raise
+    return name
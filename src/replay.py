@@ -0,0 +1,333 @@
+# src/replay.py
+
+"""
+Replay di un file di capture (JSONL) contro l'endpoint /ask del server.
+
+Il file si ottiene avviando il server con RAG_CAPTURE_PATH impostato:
+ogni riga contiene almeno il campo "query".
+
+Modalità di carico:
+- open-loop  (--rate R):        le richieste partono a R req/s indipendentemente
+                                dalle risposte (come il traffico reale).
+- closed-loop (--concurrency C): C client, ognuno invia la richiesta successiva
+                                solo dopo aver ricevuto la risposta.
+- sweep      (--sweep R1,R2,..): esegue più run open-loop a rate crescenti e
+                                indica il punto di saturazione.
+
+Per non consumare quota Gemini, avviare il server con RAG_STUB_LLM=1.
+
+Esempio:
+    RAG_STUB_LLM=1 python app/server.py
+    python src/replay.py data/capture/ask.jsonl --rate 5 --duration 60
+"""
+
+import argparse
+import json
+import math
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_URL = "http://localhost:8000/ask"
+DEFAULT_TIMEOUT_S = 30.0
+# Un run è considerato saturo se il throughput ottenuto scende sotto
+# questa frazione del rate offerto (le richieste si accumulano in coda).
+SATURATION_THROUGHPUT_RATIO = 0.9
+# Aumento del tasso di errore (rispetto al run a rate più basso) oltre il quale
+# il run è considerato saturo: un tasso di errore costante non indica saturazione.
+SATURATION_ERROR_INCREASE = 0.01
+
+
+def load_queries(path: str) -> list[dict]:
+    """
+    Legge il file di capture e ritorna le richieste ({"query", "filter"}),
+    nell'ordine originale. Le righe vuote o non valide vengono ignorate.
+    """
+    queries: list[dict] = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            query = record.get("query") if isinstance(record, dict) else None
+            if query:
+                queries.append({"query": query, "filter": record.get("filter")})
+    return queries
+
+
+def send_request(url: str, item: dict, timeout_s: float) -> tuple[int, str]:
+    """
+    Invia una POST a /ask (form field 'text', come la pagina web,
+    più l'eventuale 'filter' registrato nel capture).
+    Ritorna (status HTTP, errore). Status 0 = errore di rete/timeout.
+    """
+    form = {"text": item["query"]}
+    if item.get("filter"):
+        form["filter"] = json.dumps(item["filter"])
+    body = urllib.parse.urlencode(form).encode("utf-8")
+    req = urllib.request.Request(url, data=body, method="POST")
+    try:
+        with urllib.request.urlopen(req, timeout=timeout_s) as resp:
+            resp.read()
+            return resp.status, ""
+    except urllib.error.HTTPError as e:
+        return e.code, f"HTTP {e.code}"
+    except Exception as e:
+        return 0, type(e).__name__
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    """
+    Percentile (nearest-rank) su una lista già ordinata.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class RunResult:
+    """
+    Raccoglie gli esiti delle richieste di un singolo run (thread-safe).
+    """
+
+    def __init__(self):
+        self.latencies_ms: list[float] = []
+        self.statuses: dict[int, int] = {}
+        self.errors: dict[str, int] = {}
+        self.completed_at: list[float] = []
+        self.elapsed_s = 0.0
+        self.offered_rate = None
+        self._lock = threading.Lock()
+
+    def add(self, latency_ms: float, status: int, error: str):
+        with self._lock:
+            self.latencies_ms.append(latency_ms)
+            self.completed_at.append(time.perf_counter())
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            if error:
+                self.errors[error] = self.errors.get(error, 0) + 1
+
+    def throughput(self) -> float:
+        """
+        Richieste completate al secondo.
+
+        In open-loop (offered_rate impostato) è misurato sulla finestra tra la
+        prima e l'ultima risposta: il tempo totale del run includerebbe anche
+        la latenza di una richiesta, sottostimando il throughput nei run brevi
+        (es. 10 richieste a 10 req/s con 1 s di latenza sembrerebbero 5 req/s).
+        Se il server non regge, le risposte si distanziano e il valore scende.
+        """
+        n = len(self.completed_at)
+        if self.offered_rate is not None and n >= 2:
+            window = max(self.completed_at) - min(self.completed_at)
+            if window > 0:
+                return (n - 1) / window
+        return n / self.elapsed_s if self.elapsed_s else 0.0
+
+    def summary(self) -> dict:
+        """
+        Calcola percentili di latenza (su tutte le richieste), throughput e tasso di errore.
+        """
+        lat = sorted(self.latencies_ms)
+        n = len(lat)
+        n_ok = self.statuses.get(200, 0)
+        throughput = self.throughput()
+        return {
+            "requests": n,
+            "offered_rate": self.offered_rate,
+            "throughput_rps": throughput,
+            "ok_rps": throughput * n_ok / n if n else 0.0,
+            "error_rate": (n - n_ok) / n if n else 0.0,
+            "p50_ms": percentile(lat, 50),
+            "p90_ms": percentile(lat, 90),
+            "p95_ms": percentile(lat, 95),
+            "p99_ms": percentile(lat, 99),
+            "max_ms": lat[-1] if lat else 0.0,
+            "statuses": dict(sorted(self.statuses.items())),
+            "errors": self.errors,
+        }
+
+
+def run_open_loop(url, queries, rate, n_requests, timeout_s, max_workers) -> RunResult:
+    """
+    Invia n_requests richieste a 'rate' req/s, senza aspettare le risposte.
+
+    La latenza è misurata dall'istante di invio *previsto*: se il client resta
+    indietro (pool pieno) il ritardo viene conteggiato, evitando la
+    "coordinated omission" che nasconderebbe la saturazione del server.
+    """
+    result = RunResult()
+    result.offered_rate = rate
+    interval = 1.0 / rate
+
+    def worker(item, scheduled):
+        status, error = send_request(url, item, timeout_s)
+        result.add((time.perf_counter() - scheduled) * 1000, status, error)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for i in range(n_requests):
+            scheduled = t0 + i * interval
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(worker, queries[i % len(queries)], scheduled)
+    result.elapsed_s = time.perf_counter() - t0
+    return result
+
+
+def run_closed_loop(url, queries, concurrency, n_requests, timeout_s) -> RunResult:
+    """
+    'concurrency' client in parallelo, ognuno invia la richiesta successiva
+    appena riceve la risposta alla precedente.
+    """
+    result = RunResult()
+    counter = iter(range(n_requests))
+    counter_lock = threading.Lock()
+
+    def client():
+        while True:
+            with counter_lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            status, error = send_request(url, queries[i % len(queries)], timeout_s)
+            result.add((time.perf_counter() - start) * 1000, status, error)
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    result.elapsed_s = time.perf_counter() - t0
+    return result
+
+
+def find_saturation_point(summaries: list[dict], p99_limit_ms: float):
+    """
+    Ritorna (ultimo rate sostenuto, primo rate saturo); ognuno può essere None.
+
+    Un run è saturo se il throughput scende sotto SATURATION_THROUGHPUT_RATIO
+    del rate offerto, se il p99 supera il limite o se il tasso di errore cresce
+    di oltre SATURATION_ERROR_INCREASE rispetto al run a rate più basso.
+    """
+    runs = sorted(summaries, key=lambda s: s["offered_rate"])
+    if not runs:
+        return None, None
+    baseline_errors = runs[0]["error_rate"]
+
+    last_ok = None
+    for s in runs:
+        rate = s["offered_rate"]
+        if (
+            s["throughput_rps"] < SATURATION_THROUGHPUT_RATIO * rate
+            or s["p99_ms"] > p99_limit_ms
+            or s["error_rate"] > baseline_errors + SATURATION_ERROR_INCREASE
+        ):
+            return last_ok, rate
+        last_ok = rate
+    return last_ok, None
+
+
+def print_summary(title: str, s: dict):
+    print(f"\n📊 {title}")
+    print(f"   Richieste:   {s['requests']}")
+    if s["offered_rate"] is not None:
+        print(f"   Rate offerto: {s['offered_rate']:.2f} req/s")
+    print(f"   Throughput:  {s['throughput_rps']:.2f} req/s (ok: {s['ok_rps']:.2f} req/s)")
+    print(f"   Errori:      {s['error_rate'] * 100:.2f}%  {s['errors'] or ''}")
+    print(f"   Status:      {s['statuses']}")
+    print(
+        f"   Latenza ms:  p50={s['p50_ms']:.1f}  p90={s['p90_ms']:.1f}  "
+        f"p95={s['p95_ms']:.1f}  p99={s['p99_ms']:.1f}  max={s['max_ms']:.1f}"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay di un capture JSONL contro /ask.")
+    parser.add_argument("capture", help="File JSONL generato con RAG_CAPTURE_PATH")
+    parser.add_argument("--url", default=DEFAULT_URL)
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("--rate", type=float, help="Open-loop: richieste al secondo")
+    mode.add_argument("--concurrency", type=int, help="Closed-loop: numero di client paralleli")
+    mode.add_argument("--sweep", help="Open-loop a rate crescenti, es. '1,2,4,8'")
+    parser.add_argument("--requests", type=int, help="Numero di richieste per run (default: tutte le query)")
+    parser.add_argument("--duration", type=float, help="Durata per run in secondi (solo open-loop)")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT_S)
+    parser.add_argument("--max-workers", type=int, default=256, help="Thread massimi in open-loop")
+    parser.add_argument("--p99-limit-ms", type=float, default=5000.0, help="SLO usato per la saturazione")
+    parser.add_argument("--report", help="Salva il report (JSON) in questo file")
+    args = parser.parse_args(argv)
+
+    rates = []
+    if args.concurrency is not None and args.concurrency <= 0:
+        parser.error("--concurrency deve essere > 0")
+    if args.rate is not None:
+        rates = [args.rate]
+    elif args.sweep is not None:
+        try:
+            rates = [float(r) for r in args.sweep.split(",")]
+        except ValueError:
+            parser.error("--sweep deve essere una lista di numeri, es. '1,2,4,8'")
+    if any(rate <= 0 for rate in rates):
+        parser.error("i rate di --rate/--sweep devono essere > 0")
+
+    queries = load_queries(args.capture)
+    if not queries:
+        print(f"❌ Nessuna query trovata in {args.capture}")
+        return 1
+    print(f"📄 Query caricate dal capture: {len(queries)}")
+
+    def n_for(rate=None):
+        if args.requests:
+            return args.requests
+        if args.duration and rate:
+            return max(1, int(args.duration * rate))
+        return len(queries)
+
+    report = {"url": args.url, "capture": args.capture, "runs": []}
+
+    if args.concurrency is not None:
+        res = run_closed_loop(args.url, queries, args.concurrency, n_for(), args.timeout)
+        s = res.summary()
+        s["concurrency"] = args.concurrency
+        print_summary(f"Closed-loop, concorrenza {args.concurrency}", s)
+        report["runs"].append(s)
+    else:
+        for rate in rates:
+            print(f"\n🚀 Run open-loop a {rate} req/s...")
+            res = run_open_loop(args.url, queries, rate, n_for(rate), args.timeout, args.max_workers)
+            s = res.summary()
+            print_summary(f"Open-loop, {rate} req/s", s)
+            report["runs"].append(s)
+
+        last_ok, saturation = find_saturation_point(report["runs"], args.p99_limit_ms)
+        report["max_sustained_rate"] = last_ok
+        report["saturation_rate"] = saturation
+        if saturation is None:
+            print(f"\n✅ Nessuna saturazione fino a {max(rates)} req/s.")
+        elif last_ok is None:
+            print(f"\n⚠️ Saturo già al rate più basso ({saturation} req/s)")
+        else:
+            print(f"\n⚠️ Ultimo rate sostenuto: {last_ok} req/s, saturazione a ~{saturation} req/s")
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"📁 Report salvato in: {args.report}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,6 +4,17 @@ import numpy as np
 import os
 import json
 
+try:
+    from src.tracing import span
+    from src.metadata import ChunkMetadata
+    from src.hierarchy import DocumentIndex
+    from src.dataprocessing import PART_SEPARATOR
+except ImportError:  # eseguito con 'src' nel path (es. evaluate.py)
+    from tracing import span
+    from metadata import ChunkMetadata
+    from hierarchy import DocumentIndex
+    from dataprocessing import PART_SEPARATOR
+
 
 class Retriever:
     """
@@ -17,22 +28,39 @@ class Retriever:
         store_path= "data/processed/vector_store",
         index_name= "dmv.index",
         chunks_name= "dmv_chunks.json",
+        metadata_name= "dmv_chunks_meta.npz",
+        hierarchical= False,
+        n_docs= 5,
+        expand_neighbors= 0,
     ):
         """
         Inizializza il modello di embedding e i path di salvataggio.
+
+        hierarchical, n_docs ed expand_neighbors sono i default di search():
+        ricerca a due livelli (documenti -> chunk), numero di documenti
+        scelti al primo livello e chunk vicini da aggiungere a ogni risultato.
         """
         self.model = SentenceTransformer(model_name)
         self.store_path = store_path
         self.index_path = os.path.join(store_path, index_name)
         self.chunks_path = os.path.join(store_path, chunks_name)
+        self.metadata_path = os.path.join(store_path, metadata_name)
 
         self.index = None
         self.chunks = []
+        self.metadata = None  # ChunkMetadata, necessario per le ricerche filtrate
+        self.hierarchical = hierarchical
+        self.n_docs = n_docs
+        self.expand_neighbors = expand_neighbors
+        self.doc_index = None  # DocumentIndex, costruito alla prima ricerca gerarchica
 
-    def build_index(self, chunks):
+    def build_index(self, chunks, chunk_records=None):
         """
         Crea l'indice FAISS a partire dagli embeddings dei chunks
         e salva sia l'indice che i chunks su disco.
+        Se chunk_records è fornito (un dict di metadati per chunk), salva
+        anche i metadati colonnari usati dai filtri di search(); altrimenti
+        rimuove quelli di un indice precedente.
         """
         print("✅ Creazione embeddings...")
         embeddings = self.model.encode(
@@ -45,6 +73,7 @@ class Retriever:
         self.index = faiss.IndexFlatL2(d)
         self.index.add(embeddings)
         self.chunks = chunks
+        self.doc_index = None
 
         # Creiamo la cartella se non esiste
         os.makedirs(self.store_path, exist_ok=True)
@@ -56,6 +85,17 @@ class Retriever:
         with open(self.chunks_path, "w", encoding="utf-8") as f:
             json.dump(self.chunks, f, ensure_ascii=False, indent=2)
 
+        if chunk_records is not None:
+            self.metadata = ChunkMetadata.from_records(chunk_records)
+            self.metadata.save(self.metadata_path)
+            print(f"✅ Metadati dei chunk salvati in: {self.metadata_path}")
+        else:
+            # Eventuali metadati precedenti non sono allineati ai nuovi chunk
+            self.metadata = None
+            if os.path.exists(self.metadata_path):
+                os.remove(self.metadata_path)
+                print(f"⚠️ Metadati obsoleti rimossi: {self.metadata_path}")
+
         print(f"✅ Indice costruito e salvato in: {self.index_path}")
         print(f"✅ Chunks salvati in: {self.chunks_path}")
 
@@ -73,29 +113,140 @@ class Retriever:
         with open(self.chunks_path, "r", encoding="utf-8") as f:
             self.chunks = json.load(f)
 
+        # I metadati sono opzionali: un vector store costruito prima
+        # della loro introduzione funziona, ma senza ricerche filtrate.
+        if os.path.exists(self.metadata_path):
+            self.metadata = ChunkMetadata.load(self.metadata_path)
+        else:
+            self.metadata = None
+            print("⚠️ Metadati dei chunk non trovati: ricerche filtrate e gerarchiche non disponibili.")
+        self.doc_index = None
+
         print("✅ Indice e chunks caricati da disco.")
 
-    def search(self, query: str, k = 3):
+    def get_document_index(self) -> DocumentIndex:
+        """
+        Indice dei documenti (media dei vettori dei chunk per doc_id),
+        costruito alla prima richiesta a partire da indice e metadati.
+        """
+        if self.doc_index is None:
+            if self.metadata is None:
+                raise ValueError("Metadati dei chunk non disponibili: ricostruisci l'indice.")
+            print("✅ Costruzione indice dei documenti...")
+            self.doc_index = DocumentIndex(self.index, self.metadata.columns["doc_id"])
+            print(f"✅ Indice dei documenti pronto: {self.doc_index.n_docs} documenti.")
+        return self.doc_index
+
+    def search(
+        self,
+        query: str,
+        k = 3,
+        filter: dict = None,
+        hierarchical: bool = None,
+        n_docs: int = None,
+        expand: int = None,
+    ):
         """
         Ritorna i k chunks più rilevanti per la query.
+
+        filter (opzionale) restringe la ricerca ai chunk con i metadati indicati,
+        es. {"field": "answers", "doc_id": [3, 7]} (vedi ChunkMetadata.filter_bitmap).
+        Il filtro è applicato dentro FAISS tramite un IDSelectorBitmap.
+
+        hierarchical: cerca prima gli n_docs documenti più vicini e poi solo
+        tra i loro chunk (vedi DocumentIndex). expand > 0 unisce a ogni
+        risultato i chunk vicini dello stesso documento che rispettano il filtro.
+        Se non indicati si usano i default passati al costruttore.
         """
         # Se l'indice non è in memoria, proviamo a caricarlo
         if self.index is None or not self.chunks:
             self.load_index()
 
+        hierarchical = self.hierarchical if hierarchical is None else hierarchical
+        n_docs = self.n_docs if n_docs is None else n_docs
+        expand = self.expand_neighbors if expand is None else expand
+        if self.metadata is None:
+            # Vector store senza metadati: solo ricerca piatta, senza espansione
+            hierarchical, expand = False, 0
+
+        bitmap = None
+        n_candidates = len(self.chunks)
+        if filter:
+            if self.metadata is None:
+                raise ValueError("Metadati dei chunk non disponibili: ricostruisci l'indice per usare i filtri.")
+            with span("filter"):
+                bitmap, n_candidates = self.metadata.filter_bitmap(filter)
+            if n_candidates == 0:
+                return []
+
         # Evitiamo di chiedere più risultati di quelli disponibili
-        k = min(k, len(self.chunks))
+        k = min(k, n_candidates)
 
         # Embedding della query
-        query_vec = self.model.encode(
-            [query],
-            convert_to_numpy=True,
-        ).astype("float32")
+        with span("encode"):
+            query_vec = self.model.encode(
+                [query],
+                convert_to_numpy=True,
+            ).astype("float32")
 
-        distances, indices = self.index.search(query_vec, k)
+        chunk_mask = None
+        if bitmap is not None and (hierarchical or expand > 0):
+            chunk_mask = np.unpackbits(bitmap, count=len(self.chunks), bitorder="little").astype(bool)
 
-        # indices[0] contiene gli indici dei migliori chunk
-        return [self.chunks[i] for i in indices[0]]
+        if hierarchical:
+            doc_index = self.get_document_index()
+            with span("faiss_search"):
+                distances, indices = doc_index.search(query_vec, k, n_docs, chunk_mask)
+        else:
+            params = None
+            if bitmap is not None:
+                # 'bitmap' e 'selector' restano referenziati fino alla fine della ricerca
+                selector = faiss.IDSelectorBitmap(bitmap)
+                params = faiss.SearchParameters(sel=selector)
+            with span("faiss_search"):
+                distances, indices = self.index.search(query_vec, k, params=params)
+            indices = indices[0]
+
+        # indices contiene gli indici dei migliori chunk (-1 = nessun risultato)
+        ids = [int(i) for i in indices if i >= 0]
+        if expand > 0:
+            return self._expand_contexts(ids, expand, chunk_mask)
+        return [self.chunks[i] for i in ids]
+
+    def _expand_contexts(self, ids, window: int, chunk_mask=None):
+        """
+        Per ogni chunk trovato unisce i 'window' chunk precedenti e successivi
+        dello stesso documento in un unico contesto. I chunk già inclusi in un
+        contesto precedente non vengono ripetuti (quindi i contesti possono essere meno di k).
+        Con chunk_mask (filtro di search()) i vicini esclusi dal filtro vengono saltati.
+
+        I chunk sono uniti in base al loro offset nel documento (colonna start_index):
+        la parte in comune con il chunk precedente viene tolta; se tra i due c'è
+        un buco (es. un chunk escluso dal filtro) si separano con PART_SEPARATOR.
+        """
+        doc_index = self.get_document_index()
+        starts = self.metadata.columns["start_index"]
+        used: set[int] = set()
+        contexts = []
+        for i in ids:
+            if i in used:
+                continue
+            group = [
+                int(j) for j in doc_index.neighbors(i, window)
+                if int(j) not in used and (chunk_mask is None or chunk_mask[j])
+            ]
+            used.update(group)
+            text = self.chunks[group[0]]
+            end = int(starts[group[0]]) + len(text)
+            for j in group[1:]:
+                chunk, start = self.chunks[j], int(starts[j])
+                if start < end:
+                    text += chunk[end - start:]
+                else:
+                    text += PART_SEPARATOR + chunk
+                end = max(end, start + len(chunk))
+            contexts.append(text)
+        return contexts
 
 '''
 # --- Esegui questo script ---
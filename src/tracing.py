@@ -0,0 +1,81 @@
+# src/tracing.py
+
+"""
+Tracing leggero per richiesta: request ID + span temporizzati.
+
+Il server apre una trace per ogni /ask con start_trace(); Retriever e
+Generator misurano le proprie fasi con `with span("nome"):`. Se nessuna
+trace è attiva (es. main.py o evaluate.py) gli span non fanno nulla.
+"""
+
+import contextvars
+import time
+import uuid
+from contextlib import contextmanager
+
+_current_trace = contextvars.ContextVar("rag_current_trace", default=None)
+
+
+class RequestTrace:
+    """
+    Raccoglie gli span (nome, durata) di una singola richiesta.
+    """
+
+    def __init__(self, request_id: str = None):
+        # Un ID passato dal client (header X-Request-ID) viene troncato per sicurezza
+        self.request_id = (request_id or uuid.uuid4().hex[:16])[:64]
+        self.spans: list[tuple[str, float]] = []
+
+    def add_span(self, name: str, duration_s: float):
+        self.spans.append((name, duration_s))
+
+    def spans_ms(self) -> dict:
+        """
+        Durata (ms) di ogni span; span con lo stesso nome vengono sommati.
+        """
+        out: dict = {}
+        for name, duration_s in self.spans:
+            out[name] = round(out.get(name, 0.0) + duration_s * 1000, 2)
+        return out
+
+
+def start_trace(request_id: str = None):
+    """
+    Attiva una nuova trace nel contesto corrente.
+    Ritorna (trace, token); il token va passato a end_trace().
+    """
+    trace = RequestTrace(request_id)
+    token = _current_trace.set(trace)
+    return trace, token
+
+
+def end_trace(token):
+    _current_trace.reset(token)
+
+
+def current_request_id() -> str:
+    trace = _current_trace.get()
+    return trace.request_id if trace else "-"
+
+
+@contextmanager
+def span(name: str):
+    """
+    Misura il blocco e lo registra nella trace attiva (se presente).
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_span(name, time.perf_counter() - start)
+
+
+def log(message: str):
+    """
+    print() con il request ID corrente come prefisso, per correlare i log.
+    """
+    print(f"[{current_request_id()}] {message}")